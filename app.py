@@ -1,5 +1,9 @@
 import logging
-from flask import Flask, render_template, request, jsonify
+import os
+import orjson
+from flask import Flask, g, render_template, jsonify
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.middleware.proxy_fix import ProxyFix
 from bedrock_client import BedrockClient
 from rate_limiter import rate_limiter, require_rate_limit
 
@@ -10,8 +14,9 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S"
 )
 
-# Set DEBUG level for bedrock_client to see all details
-logging.getLogger("bedrock_client").setLevel(logging.DEBUG)
+# Per-request details from bedrock_client are logged at DEBUG; lower this
+# level locally to see them
+logging.getLogger("bedrock_client").setLevel(logging.INFO)
 
 # Reduce noise from other libraries
 logging.getLogger("boto3").setLevel(logging.WARNING)
@@ -20,7 +25,35 @@ logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
 
+# Number of reverse proxies in front of the app that append X-Forwarded-For.
+# Leave at 0 when clients connect directly, or they can spoof their IP.
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", "0"))
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson for request parsing and jsonify."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        # orjson returns bytes; Flask expects str here
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# Stop reading bodies too large to hold a valid input, including chunked
+# bodies that have no Content-Length for require_rate_limit to check
+app.config["MAX_CONTENT_LENGTH"] = rate_limiter.max_body_bytes
+if TRUSTED_PROXY_HOPS:
+    # Resolve X-Forwarded-For so request.remote_addr is the client
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
 bedrock = BedrockClient()
 
 
@@ -32,8 +65,8 @@ def index():
 @app.route("/analyze", methods=["POST"])
 @require_rate_limit
 def analyze():
-    data = request.json
-    thought = data.get("thought", "").strip()
+    # Parsed, stripped and length-checked by require_rate_limit
+    thought = g.get("thought", "")
 
     if not thought:
         logger.warning("Empty thought received")
@@ -46,7 +79,7 @@ def analyze():
     if tokens_used > 0:
         rate_limiter.record_tokens(tokens_used)
 
-    logger.info(f"Returning result with action: {result['action']}")
+    logger.debug("Returning result with action: %s", result["action"])
     return jsonify(result)
 
 
@@ -57,5 +90,7 @@ def stats():
 
 
 if __name__ == "__main__":
+    # Development server only; set FLASK_DEBUG=1 for the reloader and
+    # serve production traffic through wsgi.py under Gunicorn
     logger.info("Starting Let Me Overthink server...")
-    app.run(host="0.0.0.0",debug=True, port=5001)
+    app.run(host="0.0.0.0", port=5001)
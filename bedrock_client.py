@@ -1,15 +1,32 @@
+import hashlib
 import json
 import logging
 import time
 import boto3
-from botocore.exceptions import ClientError
+import orjson
+from botocore.config import Config
+from botocore.exceptions import ClientError, ParamValidationError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from threading import Lock
 from typing import Optional
 
 # Configure logger for this module
 logger = logging.getLogger(__name__)
 
 MODEL_ID = "amazon.nova-micro-v1:0"
+# Request latency-optimized inference; disabled automatically if the
+# model/region combination rejects it
+LATENCY_OPTIMIZED = True
+MAX_POOL_CONNECTIONS = 64  # also caps concurrent calls in analyze_thoughts
+CACHE_SIZE = 1024  # analyzed thoughts kept for repeat submissions
+
+CLIENT_CONFIG = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    retries={"total_max_attempts": 2, "mode": "adaptive"},  # first call + 1 retry
+    tcp_keepalive=True,
+)
 
 SYSTEM_PROMPT = """You are a mental clarity assistant. Help people stop overthinking.
 
@@ -27,8 +44,18 @@ ACTION_MAP = {
     "LET_IT_GO": {"emoji": "🗑", "title": "Let it go"}
 }
 
+# Normalized action -> (response action, emoji, title), resolved in one lookup
+_ACTION_DISPATCH = {
+    action: (action.lower(), info["emoji"], info["title"])
+    for action, info in ACTION_MAP.items()
+}
+_DEFAULT_ACTION = _ACTION_DISPATCH["LET_IT_GO"]
+
+# Decodes the first complete JSON value at an offset, ignoring what follows
+_RAW_DECODER = json.JSONDecoder()
 
-@dataclass
+
+@dataclass(slots=True)
 class TokenMetrics:
     input_tokens: int = 0
     output_tokens: int = 0
@@ -36,46 +63,93 @@ class TokenMetrics:
     latency_ms: float = 0
 
     def log(self):
-        logger.info("┌─────────────────────────────────────")
-        logger.info("│ TOKEN METRICS")
-        logger.info("├─────────────────────────────────────")
-        logger.info(f"│ Input tokens:    {self.input_tokens:>6}")
-        logger.info(f"│ Output tokens:   {self.output_tokens:>6}")
-        logger.info(f"│ Total tokens:    {self.total_tokens:>6}")
-        logger.info(f"│ Latency:         {self.latency_ms:>6.0f} ms")
+        if not logger.isEnabledFor(logging.INFO):
+            return
+
+        lines = [
+            "┌─────────────────────────────────────",
+            "│ TOKEN METRICS",
+            "├─────────────────────────────────────",
+            f"│ Input tokens:    {self.input_tokens:>6}",
+            f"│ Output tokens:   {self.output_tokens:>6}",
+            f"│ Total tokens:    {self.total_tokens:>6}",
+            f"│ Latency:         {self.latency_ms:>6.0f} ms",
+        ]
         if self.latency_ms > 0:
             tokens_per_sec = (self.output_tokens / self.latency_ms) * 1000
-            logger.info(f"│ Output speed:    {tokens_per_sec:>6.1f} tok/s")
-        logger.info("└─────────────────────────────────────")
+            lines.append(f"│ Output speed:    {tokens_per_sec:>6.1f} tok/s")
+        lines.append("└─────────────────────────────────────")
+        # One record for the whole box; the leading newline keeps it aligned
+        # below the formatter's prefix
+        logger.info("\n%s", "\n".join(lines))
 
 
 class BedrockClient:
     def __init__(self, region_name: str = "us-east-1"):
-        logger.info(f"Initializing Bedrock client | Region: {region_name} | Model: {MODEL_ID}")
-        self.client = boto3.client("bedrock-runtime", region_name=region_name)
+        logger.info("Initializing Bedrock client | Region: %s | Model: %s", region_name, MODEL_ID)
+        self.client = boto3.client(
+            "bedrock-runtime", region_name=region_name, config=CLIENT_CONFIG
+        )
         self.model_id = MODEL_ID
+        self._latency_optimized = LATENCY_OPTIMIZED
         self._total_requests = 0
         self._total_input_tokens = 0
         self._total_output_tokens = 0
+        self._stats_lock = Lock()
+        self._cache: OrderedDict[bytes, dict] = OrderedDict()
+        self._cache_lock = Lock()
 
     def analyze_thought(self, thought: str) -> dict:
-        self._total_requests += 1
-        request_id = self._total_requests
-
-        logger.info(f"REQUEST #{request_id}")
-
         try:
-            return self._call_bedrock(thought, request_id)
+            # Callers pass thoughts already stripped (see require_rate_limit)
+            cache_key = hashlib.blake2b(
+                thought.lower().encode(), digest_size=16
+            ).digest()
+            with self._cache_lock:
+                cached = self._cache.get(cache_key)
+                if cached is not None:
+                    self._cache.move_to_end(cache_key)
+            if cached is not None:
+                logger.debug("Cache hit, skipping Bedrock call")
+                # Copy so callers can't mutate the cached result; no tokens spent
+                return {**cached, "tokens_used": 0}
+
+            with self._stats_lock:
+                self._total_requests += 1
+                request_id = self._total_requests
+
+            logger.debug("REQUEST #%d", request_id)
+
+            result = self._call_bedrock(thought, request_id)
         except ClientError as e:
             error_code = e.response.get("Error", {}).get("Code", "Unknown")
             error_msg = e.response.get("Error", {}).get("Message", str(e))
-            logger.error(f"Bedrock API Error | Code: {error_code}")
-            logger.error(f"Message: {error_msg}")
+            logger.error("Bedrock API Error | Code: %s", error_code)
+            logger.error("Message: %s", error_msg)
             return self._fallback_response()
         except Exception as e:
-            logger.exception(f"Unexpected error: {e}")
+            logger.exception("Unexpected error: %s", e)
             return self._fallback_response()
 
+        # Only successful analyses are cached; fallbacks should be retried
+        with self._cache_lock:
+            self._cache[cache_key] = dict(result)
+            if len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result
+
+    def analyze_thoughts(self, thoughts: list[str]) -> list[dict]:
+        """Analyze several thoughts with concurrent Bedrock calls, preserving order."""
+        if not thoughts:
+            return []
+        if len(thoughts) == 1:
+            return [self.analyze_thought(thoughts[0])]
+
+        # boto3 clients are thread-safe, so the calls can share self.client
+        max_workers = min(len(thoughts), MAX_POOL_CONNECTIONS)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.analyze_thought, thoughts))
+
     def _call_bedrock(self, thought: str, request_id: int) -> dict:
         request_params = {
             "modelId": self.model_id,
@@ -84,10 +158,10 @@ class BedrockClient:
             "inferenceConfig": {"maxTokens": 300, "temperature": 0.7}
         }
 
-        logger.debug(f"Request config: maxTokens=300, temperature=0.7")
+        logger.debug("Request config: maxTokens=300, temperature=0.7")
 
         start_time = time.time()
-        response = self.client.converse(**request_params)
+        response = self._converse(request_params)
         latency_ms = (time.time() - start_time) * 1000
 
         # Extract token metrics
@@ -100,48 +174,89 @@ class BedrockClient:
             metrics.total_tokens = metrics.input_tokens + metrics.output_tokens
 
             # Update session totals
-            self._total_input_tokens += metrics.input_tokens
-            self._total_output_tokens += metrics.output_tokens
+            with self._stats_lock:
+                self._total_input_tokens += metrics.input_tokens
+                self._total_output_tokens += metrics.output_tokens
 
         # Log token metrics
         metrics.log()
 
         # Log session totals
-        logger.info(f"Session totals: {self._total_requests} requests | "
-                   f"{self._total_input_tokens} in | {self._total_output_tokens} out")
+        logger.debug("Session totals: %d requests | %d in | %d out",
+                     self._total_requests, self._total_input_tokens,
+                     self._total_output_tokens)
 
         # Extract and parse result
         result_text = response["output"]["message"]["content"][0]["text"]
 
         # Log stop reason if available
         if "stopReason" in response:
-            logger.debug(f"Stop reason: {response['stopReason']}")
+            logger.debug("Stop reason: %s", response["stopReason"])
 
         parsed_result = self._parse_response(result_text)
         parsed_result["tokens_used"] = metrics.total_tokens
 
         return parsed_result
 
+    def _converse(self, request_params: dict) -> dict:
+        if not self._latency_optimized:
+            return self.client.converse(**request_params)
+
+        try:
+            return self.client.converse(
+                performanceConfig={"latency": "optimized"}, **request_params
+            )
+        except ParamValidationError:
+            # Installed botocore predates performanceConfig and rejects it
+            # locally, before any request is sent
+            pass
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ValidationException":
+                raise
+
+        # Only stop asking for it once a standard call succeeds, so an
+        # unrelated validation error doesn't switch the feature off
+        response = self.client.converse(**request_params)
+        logger.warning(
+            "Latency-optimized inference not available for %s, "
+            "using standard inference", self.model_id
+        )
+        self._latency_optimized = False
+        return response
+
     def _parse_response(self, result_text: str) -> dict:
+        # find() walks the leading prose and rfind() the trailing prose, so
+        # between them each character is visited at most once
         start = result_text.find("{")
-        end = result_text.rfind("}") + 1
+        end = result_text.rfind("}", start + 1) + 1
 
         if start == -1 or end <= start:
             logger.warning("No JSON found in response")
             raise ValueError("No JSON found in response")
 
-        json_str = result_text[start:end]
-        result = json.loads(json_str)
-
-        action = result.get("action", "LET_IT_GO").upper().replace(" ", "_")
-        if action not in ACTION_MAP:
-            logger.warning(f"Unknown action '{action}', defaulting to LET_IT_GO")
-            action = "LET_IT_GO"
+        # Usually the model returns bare JSON, so avoid copying a slice
+        if start == 0 and end == len(result_text):
+            json_str = result_text
+        else:
+            json_str = result_text[start:end]
+        try:
+            result = orjson.loads(json_str)
+        except orjson.JSONDecodeError:
+            # Verbose output can have braces in the prose after the object;
+            # decode just the first balanced object in a single C-level scan
+            result, _ = _RAW_DECODER.raw_decode(result_text, start)
+
+        raw_action = result.get("action", "LET_IT_GO").upper().replace(" ", "_")
+        dispatch = _ACTION_DISPATCH.get(raw_action)
+        if dispatch is None:
+            logger.warning("Unknown action '%s', defaulting to LET_IT_GO", raw_action)
+            dispatch = _DEFAULT_ACTION
+        action, emoji, title = dispatch
 
         return {
-            "action": action.lower(),
-            "emoji": ACTION_MAP[action]["emoji"],
-            "title": ACTION_MAP[action]["title"],
+            "action": action,
+            "emoji": emoji,
+            "title": title,
             "summary": result.get("summary", ""),
             "reason": result.get("reason", ""),
             "next_step": result.get("next_step", "")
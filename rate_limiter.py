@@ -1,10 +1,11 @@
 import logging
 import time
-from collections import defaultdict
+from collections import OrderedDict, deque
 from dataclasses import dataclass, field
 from threading import Lock
 from functools import wraps
-from flask import request, jsonify
+from flask import g, request, jsonify
+from werkzeug.exceptions import RequestEntityTooLarge
 
 logger = logging.getLogger(__name__)
 
@@ -12,14 +13,23 @@ logger = logging.getLogger(__name__)
 REQUESTS_PER_MINUTE = 10
 TOKENS_PER_HOUR = 10000
 MAX_INPUT_LENGTH = 2000  # characters
+# Upper bound on body size for a valid input: the longest JSON encoding of one
+# character is an escaped surrogate pair (12 bytes), plus room for the envelope
+MAX_BYTES_PER_CHAR = 12
+JSON_ENVELOPE_BYTES = 64
+N_SHARDS = 64  # lock stripes; must be a power of two
+MAX_TRACKED_CLIENTS = 100_000
+USAGE_IDLE_TTL = 3600  # seconds; matches the token window, so idle entries are empty
 
 
 @dataclass
 class UserUsage:
-    request_timestamps: list = field(default_factory=list)
-    token_usage: list = field(default_factory=list)  # (timestamp, tokens)
+    request_timestamps: deque = field(default_factory=deque)
+    token_usage: deque = field(default_factory=deque)  # (timestamp, tokens)
+    tokens_in_window: int = 0  # running sum of token_usage
     total_requests: int = 0
     total_tokens: int = 0
+    last_seen: float = 0.0
 
 
 class RateLimiter:
@@ -32,126 +42,198 @@ class RateLimiter:
         self.requests_per_minute = requests_per_minute
         self.tokens_per_hour = tokens_per_hour
         self.max_input_length = max_input_length
-        self._usage: dict[str, UserUsage] = defaultdict(UserUsage)
-        self._lock = Lock()
+        self.max_body_bytes = max_input_length * MAX_BYTES_PER_CHAR + JSON_ENVELOPE_BYTES
+        # Each shard owns its own dict and lock so unrelated IPs don't contend.
+        # Dicts are kept in least-recently-seen order for eviction.
+        self._usage: list[OrderedDict[str, UserUsage]] = [
+            OrderedDict() for _ in range(N_SHARDS)
+        ]
+        self._locks = [Lock() for _ in range(N_SHARDS)]
+        # Lifetime totals of evicted clients, so aggregate stats stay accurate
+        self._evicted_requests = [0] * N_SHARDS
+        self._evicted_tokens = [0] * N_SHARDS
 
         logger.info(
-            f"Rate limiter initialized | "
-            f"Requests: {requests_per_minute}/min | "
-            f"Tokens: {tokens_per_hour}/hour | "
-            f"Max input: {max_input_length} chars"
+            "Rate limiter initialized | "
+            "Requests: %d/min | "
+            "Tokens: %d/hour | "
+            "Max input: %d chars",
+            requests_per_minute, tokens_per_hour, max_input_length
         )
 
+    def _shard_for(self, client_ip: str) -> int:
+        """Get the shard index owning a client's usage."""
+        return hash(client_ip) & (N_SHARDS - 1)
+
+    def _get_usage(self, shard: int, client_ip: str, now: float) -> UserUsage:
+        """Get or create a client's usage and evict stale clients. Caller holds the shard lock."""
+        shard_usage = self._usage[shard]
+        usage = shard_usage.get(client_ip)
+        if usage is None:
+            # A full window blocks further requests, so it never needs to hold
+            # more than requests_per_minute timestamps
+            usage = shard_usage[client_ip] = UserUsage(
+                request_timestamps=deque(maxlen=self.requests_per_minute)
+            )
+        else:
+            shard_usage.move_to_end(client_ip)
+        usage.last_seen = now
+
+        # Drop clients idle past the TTL, plus the least recently seen ones if
+        # the shard is over capacity. The current client is last, so it stays.
+        idle_before = now - USAGE_IDLE_TTL
+        max_clients = MAX_TRACKED_CLIENTS // N_SHARDS
+        while len(shard_usage) > 1:
+            oldest = next(iter(shard_usage.values()))
+            if oldest.last_seen > idle_before and len(shard_usage) <= max_clients:
+                break
+            shard_usage.popitem(last=False)
+            self._evicted_requests[shard] += oldest.total_requests
+            self._evicted_tokens[shard] += oldest.total_tokens
+
+        return usage
+
     def _get_client_ip(self) -> str:
-        """Get client IP, handling proxies."""
-        if request.headers.get("X-Forwarded-For"):
-            return request.headers.get("X-Forwarded-For").split(",")[0].strip()
-        return request.remote_addr or "unknown"
+        """Get client IP, cached for the rest of the request."""
+        # Proxy headers are resolved into remote_addr by ProxyFix in app.py
+        # when TRUSTED_PROXY_HOPS is set
+        if "client_ip" not in g:
+            g.client_ip = request.remote_addr or "unknown"
+        return g.client_ip
 
     def _cleanup_old_entries(self, usage: UserUsage, now: float):
         """Remove expired timestamps."""
+        # Entries are appended in time order, so expired ones sit at the left
         minute_ago = now - 60
         hour_ago = now - 3600
 
-        usage.request_timestamps = [
-            ts for ts in usage.request_timestamps if ts > minute_ago
-        ]
-        usage.token_usage = [
-            (ts, tokens) for ts, tokens in usage.token_usage if ts > hour_ago
-        ]
-
-    def check_request_limit(self) -> tuple[bool, str | None]:
-        """Check if request is within rate limits."""
-        client_ip = self._get_client_ip()
-        now = time.time()
+        timestamps = usage.request_timestamps
+        while timestamps and timestamps[0] <= minute_ago:
+            timestamps.popleft()
 
-        with self._lock:
-            usage = self._usage[client_ip]
-            self._cleanup_old_entries(usage, now)
+        token_usage = usage.token_usage
+        while token_usage and token_usage[0][0] <= hour_ago:
+            _, tokens = token_usage.popleft()
+            usage.tokens_in_window -= tokens
 
-            # Check requests per minute
-            if len(usage.request_timestamps) >= self.requests_per_minute:
-                oldest = min(usage.request_timestamps)
-                wait_time = int(60 - (now - oldest)) + 1
-                logger.warning(
-                    f"Rate limit exceeded | IP: {client_ip} | "
-                    f"Requests: {len(usage.request_timestamps)}/{self.requests_per_minute}/min"
-                )
-                return False, f"Too many requests. Please wait {wait_time} seconds."
+    def _check_limits(
+        self, client_ip: str, usage: UserUsage, now: float
+    ) -> tuple[bool, str | None]:
+        """Check a client's usage against the limits. Caller holds the shard lock."""
+        self._cleanup_old_entries(usage, now)
 
-            # Check tokens per hour
-            tokens_used = sum(tokens for _, tokens in usage.token_usage)
-            if tokens_used >= self.tokens_per_hour:
-                logger.warning(
-                    f"Token limit exceeded | IP: {client_ip} | "
-                    f"Tokens: {tokens_used}/{self.tokens_per_hour}/hour"
-                )
-                return False, "Token limit exceeded. Please try again later."
-
-            return True, None
+        # Check requests per minute
+        requests_this_minute = len(usage.request_timestamps)
+        if requests_this_minute >= self.requests_per_minute:
+            oldest = usage.request_timestamps[0]  # deque is in time order
+            wait_time = int(60 - (now - oldest)) + 1
+            logger.warning(
+                "Rate limit exceeded | IP: %s | Requests: %d/%d/min",
+                client_ip, requests_this_minute, self.requests_per_minute
+            )
+            return False, f"Too many requests. Please wait {wait_time} seconds."
 
-    def check_input_length(self, text: str) -> tuple[bool, str | None]:
-        """Check if input is within length limits."""
-        if len(text) > self.max_input_length:
+        # Check tokens per hour
+        tokens_used = usage.tokens_in_window
+        if tokens_used >= self.tokens_per_hour:
             logger.warning(
-                f"Input too long | Length: {len(text)} | Max: {self.max_input_length}"
+                "Token limit exceeded | IP: %s | Tokens: %d/%d/hour",
+                client_ip, tokens_used, self.tokens_per_hour
             )
-            return False, f"Input too long. Maximum {self.max_input_length} characters allowed."
+            return False, "Token limit exceeded. Please try again later."
+
         return True, None
 
-    def record_request(self):
-        """Record a request for the current client."""
+    def try_acquire(self) -> tuple[bool, str | None]:
+        """Check rate limits and, if allowed, record the request atomically."""
         client_ip = self._get_client_ip()
         now = time.time()
 
-        with self._lock:
-            usage = self._usage[client_ip]
+        shard = self._shard_for(client_ip)
+        with self._locks[shard]:
+            usage = self._get_usage(shard, client_ip, now)
+            allowed, error_msg = self._check_limits(client_ip, usage, now)
+            if not allowed:
+                return False, error_msg
+
             usage.request_timestamps.append(now)
             usage.total_requests += 1
 
             logger.debug(
-                f"Request recorded | IP: {client_ip} | "
-                f"Requests this minute: {len(usage.request_timestamps)}"
+                "Request recorded | IP: %s | Requests this minute: %d",
+                client_ip, len(usage.request_timestamps)
             )
+            return True, None
+
+    def check_input_length(self, text: str) -> tuple[bool, str | None]:
+        """Check if input is within length limits."""
+        length = len(text)
+        if length > self.max_input_length:
+            logger.warning(
+                "Input too long | Length: %d | Max: %d",
+                length, self.max_input_length
+            )
+            return False, f"Input too long. Maximum {self.max_input_length} characters allowed."
+        return True, None
+
+    def check_body_size(self, content_length: int | None) -> tuple[bool, str | None]:
+        """Check if a request body could hold an input within length limits."""
+        if content_length and content_length > self.max_body_bytes:
+            logger.warning(
+                "Request body too large | Bytes: %d | Max: %d",
+                content_length, self.max_body_bytes
+            )
+            return False, f"Input too long. Maximum {self.max_input_length} characters allowed."
+        return True, None
 
     def record_tokens(self, tokens: int):
         """Record token usage for the current client."""
         client_ip = self._get_client_ip()
         now = time.time()
 
-        with self._lock:
-            usage = self._usage[client_ip]
+        shard = self._shard_for(client_ip)
+        with self._locks[shard]:
+            usage = self._get_usage(shard, client_ip, now)
+            self._cleanup_old_entries(usage, now)
             usage.token_usage.append((now, tokens))
+            usage.tokens_in_window += tokens
             usage.total_tokens += tokens
 
-            tokens_this_hour = sum(t for _, t in usage.token_usage)
-            logger.info(
-                f"Tokens recorded | IP: {client_ip} | "
-                f"This request: {tokens} | "
-                f"This hour: {tokens_this_hour}/{self.tokens_per_hour}"
+            logger.debug(
+                "Tokens recorded | IP: %s | This request: %d | This hour: %d/%d",
+                client_ip, tokens, usage.tokens_in_window, self.tokens_per_hour
             )
 
     def get_usage_stats(self, client_ip: str = None) -> dict:
         """Get usage stats for a client or all clients."""
-        with self._lock:
-            if client_ip:
-                usage = self._usage.get(client_ip)
+        if client_ip:
+            shard = self._shard_for(client_ip)
+            with self._locks[shard]:
+                usage = self._usage[shard].get(client_ip)
                 if not usage:
                     return {}
                 now = time.time()
                 self._cleanup_old_entries(usage, now)
                 return {
                     "requests_this_minute": len(usage.request_timestamps),
-                    "tokens_this_hour": sum(t for _, t in usage.token_usage),
+                    "tokens_this_hour": usage.tokens_in_window,
                     "total_requests": usage.total_requests,
                     "total_tokens": usage.total_tokens,
                 }
-            else:
-                return {
-                    "total_clients": len(self._usage),
-                    "total_requests": sum(u.total_requests for u in self._usage.values()),
-                    "total_tokens": sum(u.total_tokens for u in self._usage.values()),
-                }
+
+        total_clients = total_requests = total_tokens = 0
+        for shard, shard_usage in enumerate(self._usage):
+            with self._locks[shard]:
+                total_clients += len(shard_usage)
+                total_requests += self._evicted_requests[shard]
+                total_requests += sum(u.total_requests for u in shard_usage.values())
+                total_tokens += self._evicted_tokens[shard]
+                total_tokens += sum(u.total_tokens for u in shard_usage.values())
+        return {
+            "total_clients": total_clients,
+            "total_requests": total_requests,
+            "total_tokens": total_tokens,
+        }
 
 
 # Global instance
@@ -162,21 +244,48 @@ def require_rate_limit(f):
     """Decorator to enforce rate limiting on routes."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # Check rate limit
-        allowed, error_msg = rate_limiter.check_request_limit()
+        # Check rate limit and record the request in one step
+        allowed, error_msg = rate_limiter.try_acquire()
         if not allowed:
             return jsonify({"error": error_msg, "rate_limited": True}), 429
 
         # Check input length if POST with JSON
         if request.method == "POST" and request.is_json:
+            # Reject bodies too large to hold a valid input before parsing them
+            allowed, error_msg = rate_limiter.check_body_size(request.content_length)
+            if not allowed:
+                return jsonify({"error": error_msg}), 400
+
+            # Bodies without a Content-Length (chunked) are cut off at
+            # MAX_CONTENT_LENGTH while being read (set in app.py), so a body
+            # that reaches the cap was truncated
+            try:
+                body = request.get_data(cache=True)
+            except RequestEntityTooLarge:
+                body = None
+            if body is None or len(body) >= rate_limiter.max_body_bytes:
+                logger.warning(
+                    "Request body too large | Max: %d", rate_limiter.max_body_bytes
+                )
+                error_msg = (
+                    f"Input too long. Maximum {rate_limiter.max_input_length} "
+                    f"characters allowed."
+                )
+                return jsonify({"error": error_msg}), 400
+
             data = request.get_json(silent=True) or {}
-            thought = data.get("thought", "")
+            thought = data.get("thought", "") if isinstance(data, dict) else None
+            if not isinstance(thought, str):
+                logger.warning("Invalid request body | thought is not a string")
+                return jsonify({"error": "Thought must be a string"}), 400
+
+            # Check the raw length so max_body_bytes never rejects a valid input
             allowed, error_msg = rate_limiter.check_input_length(thought)
             if not allowed:
                 return jsonify({"error": error_msg}), 400
 
-        # Record the request
-        rate_limiter.record_request()
+            # Strip once here; the route reads the result from g.thought
+            g.thought = thought.strip()
 
         return f(*args, **kwargs)
 
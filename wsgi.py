@@ -0,0 +1,2 @@
+"""WSGI entry point: gunicorn wsgi:app"""
+from app import app